@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+"""
+Startup benchmark for PDFdex.
+
+PDFdex gets run from scripts a lot, so importing it has to stay quick.
+This times importing the console interface in a fresh interpreter and
+checks that the slow optional libraries (NLTK, pdftotext, colorama)
+are not loaded just by importing it. Exits with an error if either
+check fails, so it can be run as part of testing.
+
+Usage: pdfdex_bench.py [budget in milliseconds]
+"""
+
+import os
+import subprocess
+import sys
+
+# Import time allowed, in milliseconds, for the best of several runs.
+import_budget_ms = 100
+
+# Modules that must not be imported at startup.
+deferred_modules = ["nltk", "pdftotext", "colorama"]
+
+# Imports the console in a fresh interpreter and reports how long
+# that took along with any deferred modules that got loaded.
+import_script = """
+import sys, time
+start = time.perf_counter()
+import pdfdex_console
+elapsed = time.perf_counter() - start
+loaded = [name for name in {deferred} if name in sys.modules]
+print(elapsed * 1000, " ".join(loaded))
+"""
+
+def time_import(runs = 5):
+    """Returns the fastest import time in milliseconds and the
+    deferred modules loaded during the import."""
+    script = import_script.format(deferred=deferred_modules)
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], cwd=here,
+                                capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        loaded = output[1:]
+    return min(times), loaded
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else import_budget_ms
+    elapsed, loaded = time_import()
+    print("Import time: {:.1f} ms (budget {:.0f} ms)".format(elapsed, budget))
+    
+    failed = False
+    if len(loaded) > 0:
+        print("Loaded at startup: {}".format(", ".join(loaded)))
+        failed = True
+    if elapsed > budget:
+        print("Import time is over budget!")
+        failed = True
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,15 @@ Console interface functions for PDFdex.
 import os           # For some file management stuff
 
 from pdfdex_core import *
-from colorama import Fore, Style
 
-# Some formatting stuff:
+# Some formatting stuff. colorama is imported when
+# first used to keep startup quick.
 def file_path(path):
+    from colorama import Fore, Style
     return Fore.LIGHTRED_EX + path + Style.RESET_ALL
 
 def highlight(element):
+    from colorama import Fore, Style
     return Fore.LIGHTCYAN_EX + element + Style.RESET_ALL
 
 # Start menu:
@@ -114,26 +116,53 @@ def menu():
 # String search code
 def string_search():
     """ Console front end for searching pages in pdf_dict database """
+    print("Start with 're:' to search for a regular expression.")
     search_string = input("Enter a string to search for: ")
-    results = search_pages(search_string, pdf_dict)
-    display_string_search_result(search_string, results)
     
-def display_string_search_result(string, results):
-    """Displays search results in a console."""
-    if len(results) > 0:
+    if search_string.startswith("re:"):
+        search_string = search_string[3:]
+        try:
+            re.compile(search_string)
+        except re.error as error:
+            print("Invalid regular expression: {}".format(error))
+            return
+        results = iter_regex_search_pages(search_string, pdf_dict)
+        display_string_search_result(search_string, results, regex = True)
+    else:
+        results = iter_search_pages(search_string, pdf_dict)
+        display_string_search_result(search_string, results)
+    
+def display_string_search_result(string, results, regex = False):
+    """Displays search results in a console. results can be the
+    dictionary from search_pages, or the iterator from
+    iter_search_pages, in which case results are shown as they
+    are found and Ctrl-C stops the search early. If the results
+    are for a regular expression, regex should be True."""
+    if isinstance(results, dict):
+        results = results.items()
+    
+    print('\nSearching for "{}" (Ctrl-C to stop)...'.format(highlight(string)))
+    
+    # Show each result as it comes in, keeping them
+    # so they can be picked for the concordance:
+    found = {}
+    try:
+        for key, pages in results:
+            found[key] = pages
+            print("\n{:>3} {} ({} matching pages found)".format(str(len(found)) + ')', 
+                                                                file_path(key), 
+                                                                len(pages)))
+            print("    Pages:", [result + 1 for result in pages])
+    except KeyboardInterrupt:
+        print("\nSearch stopped.")
+    
+    if len(found) > 0:
         print('\nMatches for string',
               '"{}" found in {} PDF(s).'.format(highlight(string), 
-                                                                len(results)))
+                                                                len(found)))
         
         # To get nice numerical indices for each key:
-        result_keys = [key for key in results.keys()]
-        
-        # Show each result:
-        for key in result_keys:
-            print("\n{:>3} {} ({} matching pages found)".format(str(result_keys.index(key) + 1) + ')', 
-                                                                file_path(key), 
-                                                                len(results[key])))
-            print("    Pages:", [result + 1 for result in results[key]])
+        result_keys = [key for key in found.keys()]
         
         # Ask to see if the user wants to see results in a concordance
         concordance = True
@@ -143,7 +172,8 @@ def display_string_search_result(string, results):
             if option == "":
                 concordance = False
             elif int(option) - 1 < len(result_keys):
-                display_concordance(result_keys[int(option) - 1], string)
+                key = result_keys[int(option) - 1]
+                display_concordance(key, string, pages = found[key], regex = regex)
             else:
                 print("Invalid option!")
             
@@ -256,7 +286,6 @@ def add_file_menu():
     to add a single PDF file or all PDF files in a directory.
     
     TODO:
-        - Make sure the same file (path) cannot be added more than once.
         - Probably separate out code for adding a single file.
     """
     print("\nAdd 1) single file or 2) whole directory? ")    
@@ -302,7 +331,26 @@ def add_directory_menu():
             print("File {} added!".format(file_path(dir_path + pdf)))
     
 def remove_file_menu():
-    print("Remove file not implemented.")
+    """
+    Menu option that removes a file from the database, or re-reads
+    it if the file has changed since it was added.
+    """
+    print("\nSelect PDF to remove or re-read.")
+    selection = get_pdf_from_list()
+    if selection is None:
+        return
+    
+    choice = input("1) Remove from database \t 2) Re-read file \t Choice: ")
+    if choice == "1":
+        remove_pdf(selection, pdf_dict)
+        print("File {} removed!".format(file_path(selection)))
+    elif choice == "2":
+        make_keywords = input("Autogenerate keywords? Enter 'Y' for yes: ")
+        try:
+            update_pdf(selection, pdf_dict, keywords = make_keywords.upper() == 'Y')
+            print("File {} re-read!".format(file_path(selection)))
+        except FileNotFoundError:
+            print("File {} not found!".format(file_path(selection)))
      
 def find_similar_menu():
     """
@@ -313,12 +361,16 @@ def find_similar_menu():
     
     print("Would you like to do keyword similarity (faster, less accurate)")
     print("Or full text similarity (longer, might also be inaccurate)?")
-    choice = input("1) Keyword\t2) full text")
+    print("TF-IDF shows only the closest matches, but is fast on big databases")
+    print("(the first time, it reads every PDF unless its index was saved).")
+    choice = input("1) Keyword\t2) full text\t3) TF-IDF top 10")
     
     if choice == "1":
         find_keyword_similar_menu()
     elif choice == "2":
         find_text_similar_menu()
+    elif choice == "3":
+        find_tfidf_similar_menu()
     else:
         pass
 
@@ -366,6 +418,24 @@ def find_text_similar_menu():
     for score, pdf in sorted(scores, reverse = True):
         print(" {:35} {}".format(file_path(pdf), round(score, 3)))
 
+# Similarity based on the TF-IDF index
+def find_tfidf_similar_menu(top_k = 10):
+    """
+    Shows the PDFs most similar to the selected one using the
+    TF-IDF similarity index. Only the best top_k matches are
+    scored in full, so this stays quick on large databases.
+    """
+    
+    print("We will find the PDFs whose text")
+    print("is most similar to the PDF you select.")
+    choice = get_pdf_from_list()
+    
+    scores = find_similar(choice, pdf_dict, top_k = top_k)
+    
+    print("\nTop {} TF-IDF matches for {}:".format(top_k, file_path(choice)))
+    for score, pdf in scores:
+        print(" {:35} {}".format(file_path(pdf), round(score, 3)))
+
 # Display in-line citations
 def display_cites_menu():
     """Lists all in-line citations in a given PDF.
@@ -429,8 +499,8 @@ def concordance_menu():
     
     display_concordance(selection, term)
     
-def display_concordance(pdf, term):
-    results = concordance(pdf, term)
+def display_concordance(pdf, term, pages = None, regex = False):
+    results = concordance(pdf, term, pages = pages, regex = regex)
     for result in results:
         print("{:>2} - {:>30} {} {:<30}".format(result[0] + 1, result[1], 
                                      highlight(result[2]),
@@ -453,13 +523,17 @@ def load_menu():
     load_path = input("\nEnter file name to load: ")
     
     try:
+        new_pdf_dict = load_pdf_dict(load_path)
+        close_pdf_dict(pdf_dict)
         pdf_dict.clear()
-        pdf_dict.update(load_pdf_dict(load_path))
+        pdf_dict.update(new_pdf_dict)
         dict_file = load_path
         print("\nFile {} loaded.".format(file_path(load_path)))
         print("Index contains {} entries.".format(len(pdf_dict)))
     except FileNotFoundError:
         print("File {} not found!".format(file_path(load_path)))
+    except ValueError as error:
+        print("File {} could not be loaded: {}".format(file_path(load_path), error))
 
 
 
@@ -9,34 +9,583 @@ a simple (but functional) GUI someday, but for now there will be a
 console interface.
 """
 
-import pdftotext    # For extracting text from PDFs
 import re           # For making that text useful
 import json         # For saving and loading the dictionary.
+import math         # For TF-IDF weights.
+import heapq        # For picking the best matches without a full sort.
+import os           # For replacing database files safely.
+import struct       # For the index offset at the end of a database file.
+import zlib         # For compressing page text in database files.
+import hashlib      # For identifying PDFs in the extraction cache.
+import io           # For handing PDF contents to pdftotext.
 
-from nltk.corpus import stopwords   
-from nltk import word_tokenize
+from collections import OrderedDict
+from collections.abc import MutableMapping, Sequence
+from functools import lru_cache
+
+# pdftotext and NLTK are slow to import and only needed when adding
+# PDFs or working with keywords, so they are imported where they are
+# used rather than here. Plain searches never load them.
+
+class PdfDict(dict):
+    """A dictionary of PDFs that keeps track of which pdfs have been
+    added, replaced or removed, so that indexes built from it can be
+    brought up to date without checking every pdf."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # One set of changed pdfs for each index watching this.
+        self.watchers = []
+        
+    def watch(self):
+        """Returns a set that changed pdfs will be added to."""
+        changes = set()
+        self.watchers.append(changes)
+        return changes
+    
+    def unwatch(self, changes):
+        self.watchers = [watcher for watcher in self.watchers
+                         if watcher is not changes]
+        
+    def mark(self, keys):
+        for changes in self.watchers:
+            changes.update(keys)
+            
+    def __setitem__(self, key, value):
+        self.mark([key])
+        super().__setitem__(key, value)
+        
+    def __delitem__(self, key):
+        self.mark([key])
+        super().__delitem__(key)
+        
+    def pop(self, key, *default):
+        self.mark([key])
+        return super().pop(key, *default)
+    
+    def popitem(self):
+        (key, value) = super().popitem()
+        self.mark([key])
+        return (key, value)
+    
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+    
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+            
+    def clear(self):
+        self.mark(self.keys())
+        super().clear()
+
+
+def get_changed_pdfs(index, pdf_dict):
+    """Returns the pdfs that an index is out of date on: ones that have
+    been added, removed or replaced since they were indexed.
+    index["entries"] holds the pdf_dict entry each pdf was indexed
+    from, so a pdf that has been replaced under the same path (say,
+    by loading another database) is caught too.
+    
+    For a PdfDict, only the pdfs it reports as changed are checked.
+    Anything else has to be checked pdf by pdf."""
+    entries = index["entries"]
+    
+    if index.get("source") is not pdf_dict:
+        # A different dictionary than last time, so check everything.
+        if isinstance(index.get("source"), PdfDict):
+            index["source"].unwatch(index["changes"])
+        index["source"] = pdf_dict
+        index["changes"] = None
+        if isinstance(pdf_dict, PdfDict):
+            index["changes"] = pdf_dict.watch()
+        candidates = set(entries).union(pdf_dict.keys())
+    elif index["changes"] is not None:
+        candidates = set(index["changes"])
+        index["changes"].clear()
+    else:
+        candidates = set(entries).union(pdf_dict.keys())
+        
+    return [pdf for pdf in candidates
+            if entries.get(pdf) is not pdf_dict.get(pdf)]
 
 # This a temporary dictionary that will store PDF text.
 # The goal is to eventually replace this with a file
 # that can be loaded and saved to. But one thing at a time...
-pdf_dict = {}
+pdf_dict = PdfDict()
 
 # This stores the path of the current database file
 # if one is opened.
 dict_file = ""
 
 # Loading and saving databases
+#
+# Databases are saved as:
+#
+#   DATABASE_MAGIC, the format version and a new line
+#   the pages of each PDF, in compressed blocks of block_pages pages
+#   an index: JSON with the metadata of each PDF and where its blocks are
+#   the offset of the index, as an 8-byte unsigned integer
+#
+# so that the metadata can be loaded up front and page text read
+# only when it is first needed. Blocks are compressed with zlib
+# using a preset dictionary of common words from the database, which
+# helps a lot with blocks that are too small to compress well alone.
+# Older databases, which are a single JSON dictionary, can still be
+# loaded (all at once).
+DATABASE_MAGIC = b"PDFDEX"
+
+# The version of the database format. This should go up
+# whenever the format changes, since only this version
+# can be read.
+DATABASE_VERSION = 3
+
+# How many pages go in each compressed block. Smaller blocks mean
+# less to decompress when only a few pages are needed, but compress
+# less well.
+block_pages = 8
+
+# Roughly how many characters of page text to keep in memory for
+# a lazily loaded database. Past this, the least recently used
+# blocks are dropped and re-read from disk if needed.
+page_cache_budget = 200 * 1024 * 1024
+
+def train_dictionary(pdf_dict, sample_pages = 2000, size = 32 * 1024):
+    """Builds a zlib preset dictionary out of the most common words
+    in a sample of pages from the database. zlib can only look back
+    32KB, so that is as large as the dictionary gets."""
+    counts = {}
+    sampled = 0
+    
+    # Take a few pages from each PDF so one long PDF
+    # doesn't dominate the sample.
+    for pdf in pdf_dict.keys():
+        for page in pdf_dict[pdf]["pages"][:3]:
+            for word in page[1].split():
+                counts[word] = counts.get(word, 0) + 1
+            sampled += 1
+        if sampled >= sample_pages:
+            break
+    
+    # Words are scored by how many bytes they would save. zlib
+    # prefers matches close by, so the best words go at the end.
+    scored = sorted(counts, key=lambda word: counts[word] * len(word), reverse=True)
+    words = []
+    total = 0
+    for word in scored:
+        if counts[word] < 2:
+            break
+        total += len(word.encode()) + 1
+        if total > size:
+            break
+        words.append(word)
+        
+    return " ".join(reversed(words)) + " "
+
+class DatabaseFile:
+    """An open database file that page text can be read from,
+    along with a cache of the blocks decompressed so far."""
+    
+    def __init__(self, file_path):
+        # The file stays open until close() is called, so pages
+        # can be read from it whenever they are needed.
+        self.path = file_path
+        self.file = open(file_path, 'rb')
+        
+        header = self.file.readline(32)
+        version = header[len(DATABASE_MAGIC):].strip().decode(errors="replace")
+        if version != str(DATABASE_VERSION):
+            self.file.close()
+            raise ValueError("{} is a version {} database, but only version {} "
+                             "databases can be read.".format(file_path, version,
+                                                             DATABASE_VERSION))
+        
+        # A file that has been cut short or damaged gets the same kind
+        # of error as one in the wrong format, rather than whatever
+        # happens to go wrong while reading it.
+        index_end = os.fstat(self.file.fileno()).st_size - 8
+        try:
+            if index_end < len(header):
+                raise ValueError("file is too short")
+            self.file.seek(index_end)
+            (index_offset,) = struct.unpack(">Q", self.file.read(8))
+            if not len(header) <= index_offset <= index_end:
+                raise ValueError("index offset is out of range")
+            self.file.seek(index_offset)
+            self.index = json.loads(self.file.read(index_end - index_offset))
+            self.dictionary = self.index["dictionary"]
+            self.block_pages = self.index["block_pages"]
+            if "pdfs" not in self.index:
+                raise ValueError("index lists no pdfs")
+        except (ValueError, KeyError, TypeError) as error:
+            self.file.close()
+            raise ValueError("{} is not a complete PDFdex database "
+                             "({}).".format(file_path, error))
+        self.zdict = self.dictionary.encode()
+        
+        # offset -> (pages, size), least recently used first
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        
+    def drop_blocks(self, blocks):
+        """Drops blocks that are no longer used from the cache."""
+        for (offset, length) in blocks:
+            if offset in self.cache:
+                self.cache_size -= self.cache.pop(offset)[1]
+        
+    def close(self):
+        self.file.close()
+        self.cache.clear()
+        self.cache_size = 0
+        
+    def is_file(self, file_path):
+        """Checks whether this database is the file at file_path."""
+        try:
+            return os.path.samefile(self.path, file_path)
+        except OSError:
+            return False
+        
+    def read_raw(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+        
+    def get_block(self, offset, length):
+        """Returns the pages in the block stored at offset,
+        from the cache if possible."""
+        if offset in self.cache:
+            self.cache.move_to_end(offset)
+            return self.cache[offset][0]
+        
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        pages = json.loads(decompressor.decompress(self.read_raw(offset, length)))
+        size = sum(len(page[1]) for page in pages)
+        
+        # Make room, but always keep the block we were asked for.
+        while self.cache and self.cache_size + size > page_cache_budget:
+            old_size = self.cache.popitem(last=False)[1][1]
+            self.cache_size -= old_size
+            
+        self.cache[offset] = (pages, size)
+        self.cache_size += size
+        return pages
+
+
+class LazyPages(Sequence):
+    """The pages of a PDF in a database file. Indexing or slicing
+    only decompresses the blocks holding the pages asked for."""
+    
+    def __init__(self, database, blocks, page_count):
+        self.database = database
+        self.blocks = blocks
+        self.page_count = page_count
+        
+    def __len__(self):
+        return self.page_count
+    
+    def __getitem__(self, page_index):
+        if isinstance(page_index, slice):
+            return [self[i] for i in range(*page_index.indices(self.page_count))]
+        if page_index < 0:
+            page_index += self.page_count
+        if not 0 <= page_index < self.page_count:
+            raise IndexError("page index out of range")
+        
+        (block_no, page_in_block) = divmod(page_index, self.database.block_pages)
+        (offset, length) = self.blocks[block_no]
+        return self.database.get_block(offset, length)[page_in_block]
+    
+    def __iter__(self):
+        for (offset, length) in self.blocks:
+            yield from self.database.get_block(offset, length)
+
+
+class LazyPdfEntry(MutableMapping):
+    """A pdf_dict entry from a lazily loaded database. It behaves like
+    the usual dictionary, but its "pages" are only read from the
+    database file when accessed."""
+    
+    def __init__(self, database, metadata):
+        self.data = metadata
+        self.attach(database, metadata)
+        
+    def attach(self, database, metadata):
+        """Points the entry at its pages in a database file."""
+        self.database = database
+        self.blocks = metadata.pop("blocks")
+        self.page_count = metadata.pop("page_count")
+        
+    def __getitem__(self, key):
+        # Pages that have been set directly are kept in data.
+        if key == "pages" and "pages" not in self.data:
+            return LazyPages(self.database, self.blocks, self.page_count)
+        return self.data[key]
+    
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        
+    def __delitem__(self, key):
+        if key == "pages" and "pages" not in self.data:
+            raise KeyError("Pages from a database file cannot be deleted.")
+        del self.data[key]
+        
+    def __iter__(self):
+        yield from self.data
+        if "pages" not in self.data:
+            yield "pages"
+            
+    def __len__(self):
+        return len(self.data) + ("pages" not in self.data)
+    
+    def release(self):
+        """Drops these pages from the database file's cache,
+        since they won't be used anymore."""
+        if "pages" not in self.data:
+            self.database.drop_blocks(self.blocks)
+            self.blocks = []
+            self.page_count = 0
+            
+    def raw_blocks(self, dictionary, pages_per_block):
+        """Returns the compressed blocks as stored in the database
+        file, or None if they can't be copied as they are into a
+        database using the given dictionary and block size."""
+        if ("pages" in self.data
+                or self.database.dictionary != dictionary
+                or self.database.block_pages != pages_per_block):
+            return None
+        return [self.database.read_raw(offset, length)
+                for (offset, length) in self.blocks]
+
+
+def get_databases(pdf_dict):
+    """Returns the database files that pdfs in pdf_dict are read from."""
+    databases = []
+    for pdf_data in pdf_dict.values():
+        if (isinstance(pdf_data, LazyPdfEntry)
+                and not any(pdf_data.database is database for database in databases)):
+            databases.append(pdf_data.database)
+    return databases
+
+def close_pdf_dict(pdf_dict):
+    """Closes the database files that pdfs in pdf_dict are read from.
+    This should be done before pdf_dict is replaced with another
+    database, since pages can no longer be read afterwards."""
+    for database in get_databases(pdf_dict):
+        database.close()
+
 def load_pdf_dict(input_file_path):
-    with open(input_file_path, 'r') as input_file:
-        return json.load(input_file)
+    with open(input_file_path, 'rb') as input_file:
+        is_lazy = input_file.read(len(DATABASE_MAGIC)) == DATABASE_MAGIC
+        
+    # Older databases are a single JSON dictionary.
+    if not is_lazy:
+        with open(input_file_path, 'r') as input_file:
+            return json.load(input_file)
+    
+    database = DatabaseFile(input_file_path)
+    pdf_entries = {pdf: LazyPdfEntry(database, metadata)
+                   for pdf, metadata in database.index["pdfs"].items()}
+    
+    # The similarity index is restored along with the database, so
+    # it doesn't have to be rebuilt by reading every page.
+    if "similarity" in database.index:
+        restore_similarity_index(database.index.pop("similarity"), pdf_entries)
+        
+    return pdf_entries
 
 def save_pdf_dict(output_file_path):
-    with open(output_file_path, 'w') as output_file:
-        json.dump(pdf_dict, output_file)
+    # Reuse the dictionary of a loaded database if there is one,
+    # so that its blocks can be copied without recompressing them.
+    dictionary = None
+    pages_per_block = block_pages
+    for pdf_data in pdf_dict.values():
+        if isinstance(pdf_data, LazyPdfEntry):
+            dictionary = pdf_data.database.dictionary
+            pages_per_block = pdf_data.database.block_pages
+            break
+    if dictionary is None:
+        dictionary = train_dictionary(pdf_dict)
+    zdict = dictionary.encode()
+    
+    # Write to a temporary file first, since the pages of a lazily
+    # loaded database may still be read from output_file_path.
+    # Once it has been written, any database open on output_file_path
+    # is closed (files that are open can't be replaced on Windows) and
+    # its pdfs are pointed at the new file.
+    temp_path = output_file_path + ".tmp"
+    pdfs = {}
+    
+    with open(temp_path, 'wb') as output_file:
+        output_file.write(DATABASE_MAGIC + "{}\n".format(DATABASE_VERSION).encode())
+        
+        for pdf, pdf_data in pdf_dict.items():
+            raw_blocks = None
+            if isinstance(pdf_data, LazyPdfEntry):
+                raw_blocks = pdf_data.raw_blocks(dictionary, pages_per_block)
+                
+            if raw_blocks is None:
+                pages = list(pdf_data["pages"])
+                raw_blocks = []
+                for start in range(0, len(pages), pages_per_block):
+                    compressor = zlib.compressobj(9, zdict=zdict)
+                    block = json.dumps(pages[start:start + pages_per_block]).encode()
+                    raw_blocks.append(compressor.compress(block) + compressor.flush())
+                page_count = len(pages)
+            else:
+                page_count = pdf_data.page_count
+                
+            metadata = {key: pdf_data[key] for key in pdf_data if key != "pages"}
+            metadata["page_count"] = page_count
+            metadata["blocks"] = []
+            for raw in raw_blocks:
+                metadata["blocks"].append( (output_file.tell(), len(raw)) )
+                output_file.write(raw)
+            pdfs[pdf] = metadata
+            
+        index = {
+                "dictionary": dictionary,
+                "block_pages": pages_per_block,
+                "pdfs": pdfs
+            }
+        similarity = export_similarity_index(pdf_dict)
+        if similarity is not None:
+            index["similarity"] = similarity
+        index_offset = output_file.tell()
+        output_file.write(json.dumps(index).encode())
+        output_file.write(struct.pack(">Q", index_offset))
+    
+    replaced = [database for database in get_databases(pdf_dict)
+                if database.is_file(output_file_path)]
+    for database in replaced:
+        database.close()
+        
+    os.replace(temp_path, output_file_path)
+    
+    if len(replaced) > 0:
+        database = DatabaseFile(output_file_path)
+        for pdf, pdf_data in pdf_dict.items():
+            if isinstance(pdf_data, LazyPdfEntry) and pdf_data.database in replaced:
+                pdf_data.attach(database, dict(database.index["pdfs"][pdf]))
 
 
 # Tools for building pdf_dict:
 
+# Extraction cache
+#
+# Extracting text with pdftotext is the slow part of adding a PDF,
+# and the same PDFs often end up in more than one database. So the
+# normalized page text is cached on disk by the SHA-256 hash of the
+# file's contents, shared by every database, and a PDF that has been
+# seen before doesn't have to be extracted again. Set
+# extraction_cache_dir to None to turn the cache off.
+extraction_cache_dir = os.environ.get("PDFDEX_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "pdfdex", "text"))
+
+# Roughly how many bytes the cache may take up. Past this, the least
+# recently used cache files are deleted.
+extraction_cache_budget = 1024 * 1024 * 1024
+
+# This should go up whenever the text normalization in proc_pdf
+# changes, so that text normalized the old way isn't used.
+extraction_cache_version = 1
+
+# Size of the cache directory, worked out the first
+# time something is stored in it.
+extraction_cache_size = None
+
+def get_cache_path(file_hash):
+    return os.path.join(extraction_cache_dir,
+                        "{}.v{}.json.z".format(file_hash, extraction_cache_version))
+
+def load_cached_pages(file_hash):
+    """Returns the cached page texts of the file with the
+    given hash, or None if they aren't in the cache."""
+    if extraction_cache_dir is None:
+        return None
+    
+    cache_path = get_cache_path(file_hash)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            page_texts = json.loads(zlib.decompress(cache_file.read()))
+    except (OSError, ValueError, zlib.error):
+        return None
+    
+    # Mark the file as recently used. This can fail (say, if another
+    # user wrote the file), but the pages are still good to use.
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    
+    return page_texts
+
+def store_cached_pages(file_hash, page_texts):
+    """Stores the page texts of the file with the given hash in the
+    cache. The cache is only there to save time, so if it can't be
+    written to, nothing happens."""
+    global extraction_cache_size
+    if extraction_cache_dir is None:
+        return
+    
+    cache_path = get_cache_path(file_hash)
+    data = zlib.compress(json.dumps(page_texts).encode())
+    
+    # Write to a temporary file first, since other
+    # processes may be using the cache too.
+    temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    try:
+        os.makedirs(extraction_cache_dir, exist_ok=True)
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        return
+    
+    if extraction_cache_size is None:
+        extraction_cache_size = sum(size for (mtime, size, path)
+                                    in list_cache_files())
+    else:
+        extraction_cache_size += len(data)
+        
+    if extraction_cache_size > extraction_cache_budget:
+        evict_cached_pages()
+
+def list_cache_files():
+    """Returns (modification time, size, path) tuples for the files in
+    the cache directory. Only cache files themselves are listed, so that
+    anything else in the directory (including other processes' temporary
+    files) is left alone."""
+    cache_file_pattern = re.compile(r"[0-9a-f]{64}\.v\d+\.json\.z")
+    entries = []
+    for entry in os.scandir(extraction_cache_dir):
+        if not cache_file_pattern.fullmatch(entry.name):
+            continue
+        try:
+            stat = entry.stat()
+            if entry.is_file():
+                entries.append( (stat.st_mtime, stat.st_size, entry.path) )
+        except OSError:
+            pass
+    return entries
+
+def evict_cached_pages():
+    """Deletes the least recently used cache files until the cache is
+    back under 90% of its budget, so that the next few stores don't
+    have to evict again."""
+    global extraction_cache_size
+    entries = sorted(list_cache_files())
+    
+    extraction_cache_size = sum(size for (mtime, size, path) in entries)
+    for (mtime, size, path) in entries:
+        if extraction_cache_size <= 0.9 * extraction_cache_budget:
+            break
+        try:
+            os.remove(path)
+            extraction_cache_size -= size
+        except OSError:
+            pass
+
 def proc_pdf(pdf_path, generate_keywords = False):
     """Processes an individual PDF file. Takes the text from each
     page of the pdf and makes a list of (page, text) tuples so that
@@ -44,11 +593,46 @@ def proc_pdf(pdf_path, generate_keywords = False):
     
     """
     
+    # The text of PDFs that have been read before
+    # (say, for another database) is in the cache.
+    with open(pdf_path, 'rb') as pdf_file:
+        pdf_bytes = pdf_file.read()
+    file_hash = hashlib.sha256(pdf_bytes).hexdigest()
+    cached_pages = load_cached_pages(file_hash)
+    
+    if cached_pages is not None:
+        pdf_pages = [(page_no, page_text)
+                     for (page_no, page_text) in enumerate(cached_pages)]
+    else:
+        pdf_pages = extract_pages(pdf_bytes)
+        store_cached_pages(file_hash,
+                           [page_text for (page_no, page_text) in pdf_pages])
+    
+    # Generate keywords
+    if generate_keywords:
+        pdf_keywords = get_keywords(pdf_pages)
+    else:
+        pdf_keywords = []
+        
+    pdf_data = {
+            "pages": pdf_pages,
+            "path": pdf_path,
+            "keywords": pdf_keywords,
+            "user_keywords": []
+        }
+    
+    return pdf_data
+
+def extract_pages(pdf_bytes):
+    """Extracts and normalizes the text of each page of a PDF file,
+    given its contents, returning a list of (page, text) tuples."""
+    
     # Read the contents of the file using pdftotext. This used
     # to be PyPDF4, but the output of pdftotext works *much*
     # better and works with far more PDFs than PyPDF did.
-    pdf_file = open(pdf_path, 'rb')
-    pdf_reader = pdftotext.PDF(pdf_file)
+    import pdftotext
+    
+    pdf_reader = pdftotext.PDF(io.BytesIO(pdf_bytes))
     
     # We need to know how many pages the pdf file has.
     pdf_len = len(pdf_reader)
@@ -80,27 +664,17 @@ def proc_pdf(pdf_path, generate_keywords = False):
                     #]))
              #for page_no in range(pdf_len)]
     
-    
-    # Close the file, just in case...
-    pdf_file.close()
-    
-    # Generate keywords
-    if generate_keywords:
-        pdf_keywords = get_keywords(pdf_pages)
-    else:
-        pdf_keywords = []
-        
-    pdf_data = {
-            "pages": pdf_pages,
-            "path": pdf_path,
-            "keywords": pdf_keywords,
-            "user_keywords": []
-        }
-    
-    return pdf_data
+    return pdf_pages
 
 ## Keywording tools ##
 
+@lru_cache(maxsize=None)
+def get_stop_words():
+    """Returns NLTK's English stop words, importing NLTK
+    the first time they are needed."""
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
 # Generate keywords for a pdf file:
 def get_keywords(pdf_pages):
     """ Read data from a pdf_pages entry and return
@@ -108,7 +682,7 @@ def get_keywords(pdf_pages):
     always yield great results, but it kind of works."""
     
     # We'll need this for keyword detection
-    stop_words = stopwords.words('english')
+    stop_words = get_stop_words()
 
     # We will put each word token in words:
     words = []
@@ -190,6 +764,192 @@ def get_keyword_similarity(pdf1, pdf2):
     return len(intersect) / len(union)
 
 
+# Similarity index
+#
+# Comparing one PDF against every other PDF gets slow once the
+# database is large. Instead we keep a sparse TF-IDF vector for
+# each PDF along with an inverted list (term -> PDFs that contain
+# it), so that only PDFs sharing the query's most important terms
+# ever get scored.
+similarity_index = {
+        "df": {},           # term -> number of PDFs containing it
+        "vectors": {},      # pdf -> {term: weight}, unit length
+        "postings": {},     # term -> {pdf: weight}
+        "entries": {},      # pdf -> the pdf_dict entry it was indexed from
+        "built_size": 0     # number of PDFs at the last full build
+    }
+
+def get_terms(pdf_pages, stop_words):
+    """Counts the terms in the pages of a pdf, using roughly the same
+    normalization as get_keywords. Returns a {term: count} dictionary."""
+    counts = {}
+    for page in pdf_pages:
+        no_punct = re.sub(r"[^\w\s-]|_", "", page[1].lower())
+        for word in no_punct.split():
+            if len(word) > 2 and word not in stop_words:
+                counts[word] = counts.get(word, 0) + 1
+    return counts
+
+def get_tfidf_vector(term_counts, doc_count):
+    """Turns term counts into a unit-length TF-IDF vector using the
+    document frequencies currently stored in similarity_index."""
+    df = similarity_index["df"]
+    vector = {}
+    for term, count in term_counts.items():
+        idf = math.log((1 + doc_count) / (1 + df.get(term, 0))) + 1
+        vector[term] = (1 + math.log(count)) * idf
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    if norm > 0:
+        for term in vector:
+            vector[term] /= norm
+    return vector
+
+def index_similarity(pdf_list, pdf_dict, stop_words):
+    """Adds the given pdfs to similarity_index."""
+    df = similarity_index["df"]
+    postings = similarity_index["postings"]
+    
+    # Document frequencies have to be updated before any
+    # vectors are weighted.
+    all_counts = {}
+    for pdf in pdf_list:
+        all_counts[pdf] = get_terms(pdf_dict[pdf]["pages"], stop_words)
+        for term in all_counts[pdf]:
+            df[term] = df.get(term, 0) + 1
+    
+    doc_count = len(similarity_index["vectors"]) + len(pdf_list)
+    for pdf, counts in all_counts.items():
+        vector = get_tfidf_vector(counts, doc_count)
+        similarity_index["vectors"][pdf] = vector
+        similarity_index["entries"][pdf] = pdf_dict[pdf]
+        for term, weight in vector.items():
+            postings.setdefault(term, {})[pdf] = weight
+
+def unindex_similarity(pdf):
+    """Removes a pdf from similarity_index."""
+    similarity_index["entries"].pop(pdf, None)
+    vector = similarity_index["vectors"].pop(pdf, None)
+    if vector is None:
+        return
+    for term in vector:
+        del similarity_index["postings"][term][pdf]
+        similarity_index["df"][term] -= 1
+        if similarity_index["df"][term] == 0:
+            del similarity_index["df"][term]
+            del similarity_index["postings"][term]
+
+def build_similarity_index(pdf_dict):
+    """Rebuilds similarity_index from scratch."""
+    similarity_index["df"].clear()
+    similarity_index["vectors"].clear()
+    similarity_index["postings"].clear()
+    similarity_index["entries"].clear()
+    index_similarity(list(pdf_dict.keys()), pdf_dict, get_stop_words())
+    similarity_index["built_size"] = len(pdf_dict)
+
+def update_similarity_index(pdf_dict):
+    """Brings similarity_index in line with pdf_dict, indexing new or
+    replaced pdfs and dropping ones that are gone. New pdfs are weighted
+    with the document frequencies at the time they are added, so the
+    whole index is rebuilt if the database has doubled or halved in
+    size since the last full build."""
+    changed = get_changed_pdfs(similarity_index, pdf_dict)
+    
+    built_size = similarity_index["built_size"]
+    if (len(pdf_dict) > 2 * built_size 
+            or len(pdf_dict) < built_size / 2):
+        build_similarity_index(pdf_dict)
+        return
+    
+    for pdf in changed:
+        unindex_similarity(pdf)
+    
+    new_pdfs = [pdf for pdf in changed if pdf in pdf_dict]
+    if len(new_pdfs) > 0:
+        index_similarity(new_pdfs, pdf_dict, get_stop_words())
+
+def export_similarity_index(pdf_dict):
+    """Returns what is needed to restore similarity_index for pdf_dict,
+    for saving with the database. If the index has never been built,
+    this returns None rather than building it."""
+    if len(similarity_index["entries"]) == 0:
+        return None
+    update_similarity_index(pdf_dict)
+    
+    # The weights don't need full precision, and
+    # rounding them makes the database a lot smaller.
+    return {
+            "df": similarity_index["df"],
+            "built_size": similarity_index["built_size"],
+            "vectors": {pdf: {term: round(weight, 6) for term, weight in vector.items()}
+                        for pdf, vector in similarity_index["vectors"].items()}
+        }
+
+def restore_similarity_index(saved, pdf_entries):
+    """Replaces similarity_index with one saved by export_similarity_index.
+    pdf_entries holds the pdf_dict entries just loaded from the database,
+    which the restored vectors belong to."""
+    df = similarity_index["df"]
+    vectors = similarity_index["vectors"]
+    postings = similarity_index["postings"]
+    entries = similarity_index["entries"]
+    for part in (df, vectors, postings, entries):
+        part.clear()
+        
+    df.update(saved["df"])
+    similarity_index["built_size"] = saved["built_size"]
+    for pdf, vector in saved["vectors"].items():
+        vectors[pdf] = vector
+        entries[pdf] = pdf_entries[pdf]
+        for term, weight in vector.items():
+            postings.setdefault(term, {})[pdf] = weight
+
+def cosine_similarity(vector0, vector1):
+    """Dot product of two sparse unit-length vectors."""
+    if len(vector0) > len(vector1):
+        vector0, vector1 = vector1, vector0
+    return sum(weight * vector1.get(term, 0)
+               for term, weight in vector0.items())
+
+def find_similar(pdf, pdf_dict, top_k = 10, query_terms = 20,
+                 max_postings = 5000):
+    """Finds the top_k pdfs most similar to pdf by TF-IDF cosine
+    similarity. Returns a list of (score, pdf) tuples, best first.
+    
+    Only the query_terms heaviest terms of pdf are used to find
+    candidates, and terms that appear in more than max_postings pdfs
+    are skipped since they are common enough to say little about
+    similarity. The best candidates are then scored against the full
+    vectors.
+    """
+    update_similarity_index(pdf_dict)
+    vectors = similarity_index["vectors"]
+    postings = similarity_index["postings"]
+    query = vectors[pdf]
+    
+    terms = heapq.nlargest(query_terms, query, key=query.get)
+    
+    # If every term is common, we still need some candidates.
+    selective = [term for term in terms if len(postings[term]) <= max_postings]
+    if len(selective) > 0:
+        terms = selective
+    
+    candidate_scores = {}
+    for term in terms:
+        weight = query[term]
+        for other, other_weight in postings[term].items():
+            candidate_scores[other] = (candidate_scores.get(other, 0)
+                                       + weight * other_weight)
+    candidate_scores.pop(pdf, None)
+    
+    candidates = heapq.nlargest(top_k * 5, candidate_scores,
+                                key=candidate_scores.get)
+    scores = [(cosine_similarity(query, vectors[other]), other)
+              for other in candidates]
+    
+    return heapq.nlargest(top_k, scores)
+
+
 # Find in-line citations!
 def get_cites(pdf):
     """ Attempts to isolate citations in a document. It's still a bit
@@ -226,11 +986,38 @@ def get_cites(pdf):
 
 def add_pdf(pdf_path, pdf_dict, keywords = False):
     """Processes a pdf file and adds it to a dictionary 
-    base with all the text of every pdf file."""
-    pdf_dict[pdf_path] = proc_pdf(pdf_path, generate_keywords = keywords)
-    # Eventually, what this should do is check this against a
-    # previously generated database and not process the pdf
-    # if the pdf is already in the database.
+    base with all the text of every pdf file. If the pdf
+    is already in the database, it is re-read instead."""
+    if pdf_path in pdf_dict:
+        update_pdf(pdf_path, pdf_dict, keywords = keywords)
+    else:
+        pdf_dict[pdf_path] = proc_pdf(pdf_path, generate_keywords = keywords)
+
+def forget_pdf(pdf_path, pdf_dict):
+    """Drops everything derived from a pdf that is about to be removed
+    or replaced, without touching pdf_dict itself. Indexes pick up
+    the new version of the pdf, if any, the next time they are used."""
+    unindex_similarity(pdf_path)
+    unindex_trigrams(pdf_path)
+    
+    # Blocks of a removed pdf stay in the database file as dead space
+    # until the database is saved, which only writes out live pdfs.
+    if isinstance(pdf_dict[pdf_path], LazyPdfEntry):
+        pdf_dict[pdf_path].release()
+
+def remove_pdf(pdf_path, pdf_dict):
+    """Removes a pdf from the database, along with everything
+    derived from it."""
+    forget_pdf(pdf_path, pdf_dict)
+    del pdf_dict[pdf_path]
+
+def update_pdf(pdf_path, pdf_dict, keywords = False):
+    """Re-reads a pdf that is already in the database, for instance
+    because the file has changed. Keywords added by the user are kept."""
+    pdf_data = proc_pdf(pdf_path, generate_keywords = keywords)
+    pdf_data["user_keywords"] = pdf_dict[pdf_path]["user_keywords"]
+    forget_pdf(pdf_path, pdf_dict)
+    pdf_dict[pdf_path] = pdf_data
 
 
 # Search operations over pdf_dict
@@ -240,28 +1027,249 @@ def dict_searcher(search_term, pdf_dict):
 def search_pages(search_string, pdf_dict):
     """Search the database of pdf text for a specific string"""
     
-    # This will hold the pdf titles and the matching pages:
-    pdf_matches = {}
+    # Return matching pdfs with matching page numbers.
+    return dict(iter_search_pages(search_string, pdf_dict))
+
+def search_pdf(search_string, pdf_dict, pdf):
+    """Returns the numbers of the pages of pdf that contain
+    search_string, which should already be lower case."""
     
-    # Now we look through each PDF and its text:
-    for pdf in pdf_dict.keys():
+    # This will hold page matches for the PDF:
+    page_matches = []
+    
+    # Now we search the text of each page of the pdf
+    # and append any matching pages to page_matches:
+    for page in pdf_dict[pdf]["pages"]:
+        if search_string in page[1].lower():
+            page_matches.append(page[0])
+            
+    return page_matches
+
+def scan_search_pages(search_string, pdf_dict, max_results = None, cancel = None):
+    """Does the work for iter_search_pages and async_search_pages.
+    Yields (pdf, page_matches) for every pdf searched, including
+    pdfs with no matching pages (page_matches is then empty), so
+    callers can do something between pdfs."""
+    search_string = search_string.lower()
+    found = 0
+    
+    # Copy the keys so that pdfs can be added or removed
+    # while the search is paused between results.
+    for pdf in list(pdf_dict.keys()):
+        if cancel is not None and cancel.is_set():
+            return
+        if pdf not in pdf_dict:
+            continue
         
-        # This will hold page matches for each PDF:
-        page_matches = []
+        page_matches = search_pdf(search_string, pdf_dict, pdf)
+        yield (pdf, page_matches)
         
-        # Now we search the text of each page of the pdf
-        # and append any matching pages to page_matches:
-        for page in pdf_dict[pdf]["pages"]:
-            if search_string.lower() in page[1].lower():
-                page_matches.append(page[0])
-                
+        if len(page_matches) > 0:
+            found += 1
+            if max_results is not None and found >= max_results:
+                return
+
+def iter_search_pages(search_string, pdf_dict, max_results = None, cancel = None):
+    """Searches like search_pages, but yields (pdf, page_matches)
+    tuples as soon as each matching pdf is found, so results can be
+    shown before the whole database has been searched.
+    
+    The search stops after max_results matching pdfs, or once cancel
+    (anything with an is_set() method, like a threading.Event) is set.
+    Closing the generator also stops it.
+    """
+    for (pdf, page_matches) in scan_search_pages(search_string, pdf_dict,
+                                                 max_results, cancel):
         # If there are no matching pages in the pdf at all,
-        # then don't add the pdf to pdf_matches.
+        # then don't yield the pdf.
         if len(page_matches) > 0:
-            pdf_matches[pdf] = page_matches
+            yield (pdf, page_matches)
+
+async def async_search_pages(search_string, pdf_dict, max_results = None, cancel = None):
+    """Asynchronous version of iter_search_pages, for use with asyncio
+    (for instance to stream results from a server). It hands control
+    back to the event loop after each pdf, so other tasks keep running
+    and cancelling the task stops the search."""
+    import asyncio
+    
+    for (pdf, page_matches) in scan_search_pages(search_string, pdf_dict,
+                                                 max_results, cancel):
+        if len(page_matches) > 0:
+            yield (pdf, page_matches)
+        await asyncio.sleep(0)
+
+# Regular expression search
+#
+# Running a regular expression over every page is slow, so we keep a
+# trigram index: for each three-character string, which pages of which
+# pdfs (with case folded) contain it. Most patterns contain some literal text
+# that any match must include, and only pages with all of its trigrams
+# need to be checked with the full regular expression.
+#
+# The index is only kept in memory, and building it means reading every
+# page, which takes several times longer than just running the regular
+# expression over every page. So the first search in a session is run
+# directly over the pages, and the index is only built once a second
+# search shows that it's likely to pay off.
+trigram_index = {
+        "trigrams": {},     # trigram -> {pdf: bitmask of page positions}
+        "pdfs": {},         # pdf -> list of its trigrams
+        "entries": {},      # pdf -> the pdf_dict entry it was indexed from
+        "searches": 0       # regular expression searches run so far
+    }
+
+def fold_case(text):
+    """Folds case for trigram_index so that characters re.IGNORECASE
+    treats as the same letter come out the same. casefold() takes care
+    of most of these (the long s and s, the Kelvin sign and k, and so
+    on), but IGNORECASE also matches i with the dotless i and the
+    dotted capital I, which are mapped to i here."""
+    return text.casefold().replace("\u0131", "i").replace("i\u0307", "i")
+
+def index_trigrams(pdf, pdf_dict):
+    """Adds a pdf to trigram_index."""
+    trigrams = trigram_index["trigrams"]
+    pdf_masks = {}
+    for position, page in enumerate(pdf_dict[pdf]["pages"]):
+        text = fold_case(page[1])
+        bit = 1 << position
+        for trigram in set(text[i:i + 3] for i in range(len(text) - 2)):
+            pdf_masks[trigram] = pdf_masks.get(trigram, 0) | bit
             
-    # Return matching pdfs with matching page numbers.
-    return pdf_matches
+    for trigram, mask in pdf_masks.items():
+        trigrams.setdefault(trigram, {})[pdf] = mask
+    trigram_index["pdfs"][pdf] = list(pdf_masks)
+    trigram_index["entries"][pdf] = pdf_dict[pdf]
+
+def unindex_trigrams(pdf):
+    """Removes a pdf from trigram_index."""
+    trigram_index["entries"].pop(pdf, None)
+    for trigram in trigram_index["pdfs"].pop(pdf, []):
+        del trigram_index["trigrams"][trigram][pdf]
+        if len(trigram_index["trigrams"][trigram]) == 0:
+            del trigram_index["trigrams"][trigram]
+
+def update_trigram_index(pdf_dict):
+    """Brings trigram_index in line with pdf_dict, indexing new or
+    replaced pdfs and dropping ones that are gone."""
+    for pdf in get_changed_pdfs(trigram_index, pdf_dict):
+        unindex_trigrams(pdf)
+        if pdf in pdf_dict:
+            index_trigrams(pdf, pdf_dict)
+
+def get_required_literals(parsed):
+    """Returns strings that any match of a parsed regular expression
+    has to contain. This errs on the side of returning too little:
+    anything optional or with alternatives is skipped, and so are
+    characters outside ASCII, since it's hard to say what they match
+    when case is ignored."""
+    literals = []
+    run = ""
+    for (op, av) in parsed:
+        op = str(op)
+        if op == "LITERAL" and av < 128:
+            run += chr(av)
+            continue
+        
+        # Anything else ends the current run of literal text.
+        if run:
+            literals.append(run)
+        run = ""
+        
+        if op in ("SUBPATTERN", "ATOMIC_GROUP"):
+            literals.extend(get_required_literals(av[-1]))
+        elif op in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT") and av[0] >= 1:
+            literals.extend(get_required_literals(av[2]))
+            
+    if run:
+        literals.append(run)
+    return literals
+
+def get_required_trigrams(pattern, flags = 0):
+    """Returns the set of case-folded trigrams that any text matching
+    pattern has to contain. An empty set means the pattern can't be
+    narrowed down and every page has to be checked."""
+    try:
+        from re import _parser as sre_parse
+    except ImportError:
+        import sre_parse
+        
+    trigrams = set()
+    for literal in get_required_literals(sre_parse.parse(pattern, flags)):
+        literal = fold_case(literal)
+        trigrams.update(literal[i:i + 3] for i in range(len(literal) - 2))
+    return trigrams
+
+def get_trigram_candidates(trigrams):
+    """Returns {pdf: bitmask} of the page positions that contain
+    all of the given trigrams, according to trigram_index."""
+    # Start from the rarest trigram, since it limits things the most.
+    postings = sorted((trigram_index["trigrams"].get(trigram, {})
+                       for trigram in trigrams), key=len)
+    candidates = {}
+    for pdf, mask in postings[0].items():
+        for other in postings[1:]:
+            mask &= other.get(pdf, 0)
+            if mask == 0:
+                break
+        if mask != 0:
+            candidates[pdf] = mask
+    return candidates
+
+def iter_regex_search_pages(pattern, pdf_dict, flags = re.IGNORECASE,
+                            max_results = None, cancel = None):
+    """Searches the database for pages matching a regular expression.
+    Yields (pdf, page_matches) tuples like iter_search_pages, and
+    takes the same max_results and cancel arguments. Like the plain
+    search, this ignores case unless other flags are given.
+    
+    From the second search on, pages are narrowed down with
+    trigram_index first (which is built or brought up to date as
+    needed), so only pages containing the literal text in the
+    pattern are checked with the full pattern.
+    """
+    regex = re.compile(pattern, flags)
+    trigrams = get_required_trigrams(pattern, flags)
+    trigram_index["searches"] += 1
+    
+    if len(trigrams) > 0 and trigram_index["searches"] > 1:
+        update_trigram_index(pdf_dict)
+        candidates = get_trigram_candidates(trigrams)
+    else:
+        # No literal text to go on (or no index yet),
+        # so check every page.
+        candidates = {pdf: -1 for pdf in pdf_dict.keys()}
+        
+    found = 0
+    for pdf, mask in candidates.items():
+        if cancel is not None and cancel.is_set():
+            return
+        
+        # The pdf may have been removed while the search was paused.
+        if pdf not in pdf_dict:
+            continue
+        
+        pages = pdf_dict[pdf]["pages"]
+        page_matches = []
+        position = 0
+        while mask != 0 and position < len(pages):
+            if mask & 1:
+                page = pages[position]
+                if regex.search(page[1]):
+                    page_matches.append(page[0])
+            mask >>= 1
+            position += 1
+        
+        if len(page_matches) > 0:
+            yield (pdf, page_matches)
+            found += 1
+            if max_results is not None and found >= max_results:
+                return
+
+def regex_search_pages(pattern, pdf_dict, flags = re.IGNORECASE):
+    """Search the database of pdf text for a regular expression.
+    Returns matching pdfs with matching page numbers, like search_pages."""
+    return dict(iter_regex_search_pages(pattern, pdf_dict, flags = flags))
 
 def search_keywords(keyword, pdf_dict):
     
@@ -298,7 +1306,8 @@ def multi_find(string, substring):
         
     return indices
 
-def concordance(pdf, term, surrounding_text = 30):
+def concordance(pdf, term, surrounding_text = 30, pages = None,
+                regex = False):
     """ 
     Generates data for displaying a concordance. The indicated pdf
     is searched for the given term, and the function returns a tuple
@@ -309,8 +1318,17 @@ def concordance(pdf, term, surrounding_text = 30):
     The length of the material before and following the term
     is determined with the surrounding_text argument and can
     be adjusted if necessary.
+    
+    If pages is given (for instance the page numbers returned by
+    search_pages), only those pages are looked at, so only they
+    have to be read from the database.
+    
+    If regex is True, term is treated as a regular expression
+    (ignoring case, like regex_search_pages).
     """
     pdf_pages = pdf_dict[pdf]['pages']
+    if pages is not None:
+        pdf_pages = [pdf_pages[page_no] for page_no in pages]
     
     results = []
     
@@ -318,32 +1336,40 @@ def concordance(pdf, term, surrounding_text = 30):
         #print("Page:", page[0], "\tLength:", len(page[1]))                      #####
         page_text_lower = page[1].lower()
         
+        if regex:
+            term_spans = [match.span() for match
+                          in re.finditer(term, page[1], re.IGNORECASE)]
+            
         # Make sure the term is actually on this page.
-        if term.lower() in page_text_lower:
+        elif term.lower() in page_text_lower:
             # If it is, look for it
             # This will need to be made a bit more complex, since
             # find() only returns the first index value.
             term_indices = multi_find(page_text_lower, term.lower())
             #print("Term '{}' found at indices {}.".format(term, term_indices))      #####
+            term_spans = [(term_index, term_index + len(term))
+                          for term_index in term_indices]
+            
+        else:
+            term_spans = []
             
-            # Get the preceding material. If the search term is toward the 
-            # beginning of the page, we want to make sure that the preceding
-            # text is long enough.
-            for term_index in term_indices:
-                term_text = page[1][term_index:term_index + len(term)]
-                if term_index > surrounding_text:
-                    preceding_text = page[1][term_index - surrounding_text:term_index]
-                else:
-                    preceding_text = page[1][0:term_index]
-                    
-                # We do the same thing for the following text...
-                if (term_index + len(term) + surrounding_text) > len(page):
-                    following_text = page[1][term_index + len(term) : term_index + len(term) + surrounding_text]
-                else:
-                    following_text = page[1][term_index + len(term):]
-                    
-                results.append( (page[0], preceding_text, 
-                                 term_text, following_text) )
+        # Get the preceding material. If the search term is toward the 
+        # beginning of the page, we want to make sure that the preceding
+        # text is long enough.
+        for (term_index, term_end) in term_spans:
+            term_text = page[1][term_index:term_end]
+            if term_index > surrounding_text:
+                preceding_text = page[1][term_index - surrounding_text:term_index]
+            else:
+                preceding_text = page[1][0:term_index]
+                
+            # We do the same thing for the following text...
+            if (term_end + surrounding_text) > len(page):
+                following_text = page[1][term_end : term_end + surrounding_text]
+            else:
+                following_text = page[1][term_end:]
+                
+            results.append( (page[0], preceding_text, 
+                             term_text, following_text) )
                 
     return results
-            